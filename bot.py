@@ -1,17 +1,23 @@
 import os
 import re
+import html
+import hashlib
 import logging
 import asyncio
-from typing import Dict
-from pytube import YouTube
-from pytube.exceptions import VideoUnavailable, RegexMatchError, PytubeError
-from moviepy.editor import VideoFileClip
+import functools
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import aiofiles
 from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
 from telegram.constants import ChatAction, ParseMode
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -19,14 +25,41 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    PicklePersistence,
+    PersistenceInput,
+    TypeHandler,
+    AIORateLimiter
 )
+from downloader import YouTubeDownloader, open_http_session, close_http_session, run_blocking
 
 # Konfigurasi
 TOKEN = os.getenv('TELEGRAM_TOKEN', 'YOUR_BOT_TOKEN')  # Gunakan environment variable atau token langsung
 TEMP_DIR = "temp_downloads"
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', '/tmp/bot_state')
+TEMP_MAX_AGE = 1800  # Detik sebelum sisa file di TEMP_DIR dianggap basi
+PORT = int(os.getenv('PORT', '8443'))
+# Tanpa WEBHOOK_SECRET diturunkan dari token, agar sama di semua instance/replika
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or hashlib.sha256(TOKEN.encode()).hexdigest()
+# Batas koneksi paralel dari server Telegram ke webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Batasi jumlah download/konversi yang berjalan bersamaan
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS') or os.getenv('MAX_CONCURRENT_JOBS', '2'))
+DOWNLOAD_SEMAPHORE = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+waiting_jobs = 0  # Jumlah request yang sedang menunggu slot download
+INFO_TTL = 600  # Detik; URL stream YouTube akan kedaluwarsa
+INFO_CACHE_SIZE = 128  # Jumlah maksimum info video di cache bersama
+# Cache hasil extract_info per video_id, dipakai bersama semua user (LRU + TTL)
+INFO_CACHE = OrderedDict()
+THUMBNAIL_URL = "https://i.ytimg.com/vi/{}/hqdefault.jpg"
+STATUS_INTERVAL = 2  # Detik minimum antar edit pesan status
+# Format audio yang dikirim: 'm4a' (salin track AAC apa adanya) atau 'mp3'
+AUDIO_OUTPUT = os.getenv('AUDIO_OUTPUT', 'm4a').lower()
+if AUDIO_OUTPUT not in ('m4a', 'mp3'):
+    raise ValueError(f"AUDIO_OUTPUT harus 'm4a' atau 'mp3', bukan {AUDIO_OUTPUT!r}")
+
 # Setup logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -37,381 +70,433 @@ logger = logging.getLogger(__name__)
 # State conversation
 MENU, PROCESSING_LINK, CHOOSING_FORMAT = range(3)
 
-class YouTubeDownloader:
-    @staticmethod
-    async def validate_url(url: str) -> bool:
-        """Validasi URL YouTube dengan regex yang lebih komprehensif"""
-        patterns = [
-            r'(https?://)?(www\.)?youtube\.com/watch\?v=([^&]+)',
-            r'(https?://)?(www\.)?youtu\.be/([^?]+)',
-            r'(https?://)?(www\.)?youtube\.com/shorts/([^?]+)',
-            r'(https?://)?(www\.)?youtube\.com/embed/([^?]+)'
-        ]
-        return any(re.match(pattern, url) for pattern in patterns)
-
-    @staticmethod
-    async def get_video_info(url: str):
-        """Dapatkan info video dengan error handling"""
+# Keyboard statis, dibuat sekali dan dipakai ulang di setiap pesan
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📥 Download Konten", callback_data='download')],
+    [InlineKeyboardButton("ℹ️ Bantuan", callback_data='help')]
+])
+FORMAT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"🎧 {AUDIO_OUTPUT.upper()} (Audio)", callback_data='audio'),
+     InlineKeyboardButton("🎥 MP4 (Video)", callback_data='mp4')],
+    [InlineKeyboardButton("⬅️ Kembali", callback_data='back')]
+])
+HELP_BACK_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("⬅️ Kembali ke Menu", callback_data='back')]
+])
+
+async def get_cached_info(video_id: str, url: str) -> dict:
+    """Ambil info video dari cache bersama, ekstrak ulang hanya jika belum ada atau kedaluwarsa"""
+    entry = INFO_CACHE.get(video_id)
+    if entry and time.time() - entry[0] <= INFO_TTL:
+        INFO_CACHE.move_to_end(video_id)
+        return entry[1]
+    
+    info = await YouTubeDownloader.get_video_info(url)
+    INFO_CACHE[video_id] = (time.time(), info)
+    INFO_CACHE.move_to_end(video_id)
+    while len(INFO_CACHE) > INFO_CACHE_SIZE:
+        INFO_CACHE.popitem(last=False)
+    return info
+
+def safe_handler(fallback=MENU):
+    """Decorator handler: error tak terduga diteruskan ke error_handler, lalu kembali ke state fallback"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            try:
+                return await func(update, context)
+            except Exception as e:
+                context.error = e
+                await error_handler(update, context)
+                return fallback
+        return wrapper
+    return decorator
+
+async def read_upload(path: str) -> bytes:
+    """Baca file hasil download untuk diupload tanpa memblokir event loop"""
+    async with aiofiles.open(path, 'rb') as f:
+        return await f.read()
+
+@asynccontextmanager
+async def download_slot(query, context: ContextTypes.DEFAULT_TYPE):
+    """Ambil slot DOWNLOAD_SEMAPHORE; jika penuh, beri tahu posisi antrian sekali"""
+    global waiting_jobs
+    if DOWNLOAD_SEMAPHORE.locked():
+        waiting_jobs += 1
         try:
-            yt = YouTube(url)
-            # Test akses ke properti dasar
-            if not all([yt.title, yt.author, yt.length]):
-                raise VideoUnavailable("Video info tidak lengkap")
-            return yt
-        except VideoUnavailable as e:
-            raise ValueError(f"Video tidak tersedia: {str(e)}")
-        except RegexMatchError:
-            raise ValueError("URL YouTube tidak valid")
-        except PytubeError as e:
-            raise ValueError(f"Error pytube: {str(e)}")
-        except Exception as e:
-            raise ValueError(f"Error tak terduga: {str(e)}")
+            await edit_status(
+                query, context,
+                text=f"🕒 <b>Antrian: Anda di urutan ke-{waiting_jobs}</b>\n"
+                     "Server sedang sibuk, download dimulai otomatis.",
+                force=True
+            )
+            await DOWNLOAD_SEMAPHORE.acquire()
+        finally:
+            waiting_jobs -= 1
+    else:
+        await DOWNLOAD_SEMAPHORE.acquire()
+    
+    try:
+        yield
+    finally:
+        DOWNLOAD_SEMAPHORE.release()
 
+async def edit_status(query, context: ContextTypes.DEFAULT_TYPE, text: str, force: bool = False):
+    """Edit pesan status; edit beruntun dalam STATUS_INTERVAL dilewati kecuali force"""
+    now = time.monotonic()
+    if not force and now - context.user_data.get('last_status', 0) < STATUS_INTERVAL:
+        return
+    context.user_data['last_status'] = now
+    # Pesan info video bisa berupa foto (thumbnail), yang diedit caption-nya
+    if query.message.photo:
+        await query.edit_message_caption(caption=text, parse_mode=ParseMode.HTML)
+    else:
+        await query.edit_message_text(text=text, parse_mode=ParseMode.HTML)
+
+@safe_handler(ConversationHandler.END)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler untuk /start"""
-    try:
-        welcome_msg = """
+    welcome_msg = """
 🌟 <b>YouTube Downloader Premium</b> 🌟
 
 🎬 Download video/audio dari YouTube
-🎧 Konversi ke MP3 berkualitas tinggi
+🎧 Download audio berkualitas tinggi
 🎥 Dapatkan video dalam resolusi HD
 
 Pilih opsi:"""
-        
-        buttons = [
-            [InlineKeyboardButton("📥 Download Konten", callback_data='download')],
-            [InlineKeyboardButton("ℹ️ Bantuan", callback_data='help')]
-        ]
-        
-        await update.message.reply_text(
-            text=welcome_msg,
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode=ParseMode.HTML
-        )
-        return MENU
-    except Exception as e:
-        logger.error(f"Error di start: {e}")
-        await update.message.reply_text(
-            "❌ Terjadi error saat memulai bot. Silakan coba lagi.",
-            parse_mode=ParseMode.HTML
-        )
-        return ConversationHandler.END
+    
+    # effective_message juga ada saat dipanggil dari tombol (cancel)
+    await update.effective_message.reply_text(
+        text=welcome_msg,
+        reply_markup=MAIN_MENU_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+    return MENU
 
+@safe_handler()
 async def handle_download(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle permintaan download"""
+    query = update.callback_query
+    await query.answer()
+    
+    await query.edit_message_text(
+        text="📩 <b>Silakan kirim link YouTube:</b>\n\n"
+             "Contoh: https://youtu.be/contoh\n"
+             "atau https://www.youtube.com/watch?v=contoh",
+        parse_mode=ParseMode.HTML
+    )
+    return PROCESSING_LINK
+
+@safe_handler(PROCESSING_LINK)
+async def process_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Proses link YouTube"""
+    url = update.message.text.strip()
+    
+    # Validasi URL sekaligus ambil ID video
+    video_id = YouTubeDownloader.extract_video_id(url)
+    if video_id is None:
+        await update.message.reply_text(
+            "❌ <b>Format URL tidak valid!</b>\n"
+            "Pastikan link berasal dari YouTube.\n"
+            "Contoh yang valid:\n"
+            "• https://youtu.be/abc123\n"
+            "• https://www.youtube.com/watch?v=abc123",
+            parse_mode=ParseMode.HTML
+        )
+        return PROCESSING_LINK
+    
+    await update.message.reply_chat_action(ChatAction.TYPING)
+    
+    # Dapatkan info video
     try:
-        query = update.callback_query
-        await query.answer()
-        
-        await query.edit_message_text(
-            text="📩 <b>Silakan kirim link YouTube:</b>\n\n"
-                 "Contoh: https://youtu.be/contoh\n"
-                 "atau https://www.youtube.com/watch?v=contoh",
+        info = await get_cached_info(video_id, url)
+    except ValueError as e:
+        await update.message.reply_text(
+            f"❌ <b>{html.escape(str(e))}</b>\n"
+            "Silakan coba dengan link yang berbeda.",
             parse_mode=ParseMode.HTML
         )
         return PROCESSING_LINK
-    except Exception as e:
-        logger.error(f"Error di handle_download: {e}")
-        await update.callback_query.message.reply_text(
-            "❌ Gagal memproses permintaan. Silakan coba lagi.",
+    
+    # Format dipilih sekali di sini, handler download tinggal memakainya
+    format_ids = YouTubeDownloader.pick_formats(info, prefer_m4a=AUDIO_OUTPUT == 'm4a')
+    if not format_ids['audio'] and not format_ids['mp4']:
+        # Tidak ada format yang bisa dikirim sama sekali: tolak sebelum download
+        await update.message.reply_text(
+            f"❌ <b>{html.escape(format_ids['reason'])}</b>\n"
+            "Batas ukuran file Telegram adalah 50MB.\n"
+            "Silakan coba dengan link yang berbeda.",
             parse_mode=ParseMode.HTML
         )
-        return MENU
-
-async def process_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Proses link YouTube"""
-    try:
-        url = update.message.text.strip()
-        
-        # Validasi URL
-        if not await YouTubeDownloader.validate_url(url):
-            await update.message.reply_text(
-                "❌ <b>Format URL tidak valid!</b>\n"
-                "Pastikan link berasal dari YouTube.\n"
-                "Contoh yang valid:\n"
-                "• https://youtu.be/abc123\n"
-                "• https://www.youtube.com/watch?v=abc123",
-                parse_mode=ParseMode.HTML
-            )
-            return PROCESSING_LINK
-        
-        await update.message.reply_chat_action(ChatAction.TYPING)
-        
-        # Dapatkan info video
-        try:
-            yt = await YouTubeDownloader.get_video_info(url)
-        except ValueError as e:
-            await update.message.reply_text(
-                f"❌ <b>{str(e)}</b>\n"
-                "Silakan coba dengan link yang berbeda.",
-                parse_mode=ParseMode.HTML
-            )
-            return PROCESSING_LINK
-        
-        # Simpan info video
-        context.user_data['video_info'] = {
-            'url': url,
-            'title': yt.title[:100],  # Batasi panjang judul
-            'author': yt.author,
-            'length': yt.length,
-            'yt_object': yt  # Simpan objek YouTube untuk digunakan nanti
-        }
-        
-        # Tampilkan info video
-        duration = f"{yt.length // 60}:{yt.length % 60:02d}"
-        caption = f"""
-🎬 <b>{yt.title}</b>
+        return PROCESSING_LINK
+    
+    # Simpan info video
+    length = int(info['duration'])
+    context.user_data['video_info'] = {
+        'url': url,
+        'video_id': video_id,
+        'title': info['title'][:100],  # Batasi panjang judul
+        'author': info['uploader'],
+        'length': length,
+        'format_ids': format_ids
+    }
+    
+    # Tampilkan info video
+    duration = f"{length // 60}:{length % 60:02d}"
+    caption = f"""
+🎬 <b>{html.escape(info['title'])}</b>
 
-👤 <i>Channel:</i> {yt.author}
+👤 <i>Channel:</i> {html.escape(info['uploader'])}
 ⏱ <i>Durasi:</i> {duration}
 
 Pilih format download:"""
-        
-        buttons = [
-            [InlineKeyboardButton("🎧 MP3 (Audio)", callback_data='mp3'),
-             InlineKeyboardButton("🎥 MP4 (Video)", callback_data='mp4')],
-            [InlineKeyboardButton("⬅️ Kembali", callback_data='back')]
-        ]
-        
-        try:
-            # Coba kirim dengan thumbnail
-            thumb_url = yt.thumbnail_url.replace('default.jpg', 'hqdefault.jpg')
-            await update.message.reply_photo(
-                photo=thumb_url,
-                caption=caption,
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode=ParseMode.HTML
-            )
-        except Exception:
-            # Fallback ke text jika thumbnail gagal
-            await update.message.reply_text(
-                text=caption,
-                reply_markup=InlineKeyboardMarkup(buttons),
-                parse_mode=ParseMode.HTML
-            )
-        
-        return CHOOSING_FORMAT
-        
-    except Exception as e:
-        logger.error(f"Error di process_link: {e}")
+    
+    try:
+        # Coba kirim dengan thumbnail; URL tetap per video_id, mudah di-cache Telegram
+        thumb_url = THUMBNAIL_URL.format(video_id)
+        await update.message.reply_photo(
+            photo=thumb_url,
+            caption=caption,
+            reply_markup=FORMAT_MARKUP,
+            parse_mode=ParseMode.HTML
+        )
+    except Exception:
+        # Fallback ke text jika thumbnail gagal
         await update.message.reply_text(
-            "❌ <b>Terjadi error saat memproses link!</b>\n"
-            "Silakan coba lagi atau gunakan link yang berbeda.",
+            text=caption,
+            reply_markup=FORMAT_MARKUP,
             parse_mode=ParseMode.HTML
         )
-        return PROCESSING_LINK
+    
+    return CHOOSING_FORMAT
 
-async def download_mp3(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Download dan konversi ke MP3"""
+@safe_handler()
+async def download_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Download audio sebagai M4A atau MP3 (sesuai AUDIO_OUTPUT)"""
     query = update.callback_query
     await query.answer()
     
+    # Folder kerja dibuat setelah dapat slot, agar tidak ikut tersapu saat antri lama
+    work_dir = None
+    
     try:
         video_info = context.user_data.get('video_info')
         if not video_info:
             raise ValueError("Sesi telah berakhir")
         
-        yt = video_info['yt_object']
+        info = await get_cached_info(video_info['video_id'], video_info['url'])
         chat_id = update.effective_chat.id
         
         # Step 1: Persiapkan download
-        await query.edit_message_text(
+        await edit_status(
+            query, context,
             text="⏳ <b>Mempersiapkan download audio...</b>",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         await context.bot.send_chat_action(chat_id, ChatAction.RECORD_AUDIO)
         
-        # Step 2: Download video
-        try:
-            stream = yt.streams.filter(
-                progressive=True,
-                file_extension='mp4'
-            ).order_by('resolution').desc().first()
+        async with download_slot(query, context):
+            # Folder kerja per request agar file antar user tidak bertabrakan
+            user_id = update.effective_user.id
+            work_dir = await run_blocking(lambda: tempfile.mkdtemp(prefix=f"u{user_id}_", dir=TEMP_DIR))
             
-            if not stream:
-                raise ValueError("Tidak bisa menemukan stream yang sesuai")
+            # Format sudah dicek ukurannya di process_link; pick_format ulang
+            # hanya untuk memunculkan pesan error yang sesuai
+            format_id = video_info.get('format_ids', {}).get('audio') \
+                or YouTubeDownloader.pick_format(
+                    info, audio_only=True, prefer_m4a=AUDIO_OUTPUT == 'm4a'
+                )
             
-            video_path = stream.download(
-                output_path=TEMP_DIR,
-                filename_prefix="temp_"
-            )
-        except Exception as e:
-            raise ValueError(f"Gagal mendownload video: {str(e)}")
-        
-        # Step 3: Konversi ke MP3
-        await query.edit_message_text(
-            text="🔧 <b>Mengkonversi ke MP3...</b>",
-            parse_mode=ParseMode.HTML
-        )
-        
-        try:
-            mp3_path = os.path.join(TEMP_DIR, f"{video_info['title'][:50]}.mp3")
-            video_clip = VideoFileClip(video_path)
-            audio_clip = video_clip.audio
-            audio_clip.write_audiofile(mp3_path)
-            audio_clip.close()
-            video_clip.close()
-        except Exception as e:
-            raise ValueError(f"Konversi gagal: {str(e)}")
-        
-        # Step 4: Kirim audio
-        await query.edit_message_text(
-            text="📤 <b>Mengunggah audio...</b>",
-            parse_mode=ParseMode.HTML
-        )
-        await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_AUDIO)
-        
-        try:
-            with open(mp3_path, 'rb') as audio_file:
+            # Step 2: Download audio saja (tanpa track video)
+            try:
+                audio_path = await YouTubeDownloader.download(info, format_id, work_dir)
+            except Exception as e:
+                raise ValueError(f"Gagal mendownload audio: {str(e)}")
+            
+            # Step 3: Siapkan file audio
+            safe_title = re.sub(r'[\\/:*?"<>|]', '_', video_info['title'][:50])
+            copy_audio = AUDIO_OUTPUT == 'm4a' and audio_path.endswith('.m4a')
+            if not copy_audio:
+                # Remux m4a hanya sekejap, status cukup untuk konversi MP3
+                await edit_status(query, context, "🔧 <b>Mengkonversi ke MP3...</b>")
+            
+            try:
+                if copy_audio:
+                    # Track AAC cukup di-remux (-c:a copy), tanpa decode/encode
+                    audio = await read_upload(await YouTubeDownloader.remux_audio(
+                        audio_path, os.path.join(work_dir, "audio.m4a")
+                    ))
+                    filename = f"{safe_title}.m4a"
+                else:
+                    # MP3 tidak ditulis ke disk, langsung diambil dari stdout ffmpeg
+                    audio = await YouTubeDownloader.convert_to_mp3(audio_path)
+                    filename = f"{safe_title}.mp3"
+            except Exception as e:
+                raise ValueError(f"Konversi gagal: {str(e)}")
+            
+            # Step 4: Kirim audio (progres upload ditunjukkan lewat chat action)
+            await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_AUDIO)
+            
+            try:
                 await context.bot.send_audio(
                     chat_id=chat_id,
-                    audio=audio_file,
+                    audio=audio,
+                    filename=filename,
                     title=video_info['title'][:30],
                     performer=video_info['author'],
                     duration=video_info['length'],
                     read_timeout=60,
                     write_timeout=60
                 )
-        except Exception as e:
-            raise ValueError(f"Upload gagal: {str(e)}")
-        
-        # Bersihkan file
-        for file_path in [video_path, mp3_path]:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
             except Exception as e:
-                logger.error(f"Error membersihkan file: {str(e)}")
+                raise ValueError(f"Upload gagal: {str(e)}")
         
         # Pesan sukses
-        await query.edit_message_text(
+        await edit_status(
+            query, context,
             text="✅ <b>Audio berhasil diunduh!</b>\n"
                  "Selamat menikmati musiknya! 🎧",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         
         return MENU
         
     except ValueError as e:
-        await query.edit_message_text(
-            text=f"❌ <b>Error:</b> {str(e)}\n\n"
+        await edit_status(
+            query, context,
+            text=f"❌ <b>Error:</b> {html.escape(str(e))}\n\n"
                  "Silakan coba lagi atau mulai sesi baru dengan /start",
-            parse_mode=ParseMode.HTML
-        )
-        return MENU
-        
-    except Exception as e:
-        logger.error(f"Error tak terduga di download_mp3: {str(e)}")
-        await query.edit_message_text(
-            text="❌ <b>Terjadi error tak terduga!</b>\n"
-                 "Silakan coba lagi nanti.",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         return MENU
+    
+    finally:
+        # Hapus folder kerja di thread agar unlink tidak memblokir event loop
+        if work_dir:
+            await run_blocking(shutil.rmtree, work_dir, True)
+        # Info video tidak dibutuhkan lagi setelah kembali ke MENU
+        context.user_data.pop('video_info', None)
+        context.user_data.pop('last_status', None)
 
+@safe_handler()
 async def download_mp4(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Download sebagai MP4"""
     query = update.callback_query
     await query.answer()
     
+    # Folder kerja dibuat setelah dapat slot, agar tidak ikut tersapu saat antri lama
+    work_dir = None
+    
     try:
         video_info = context.user_data.get('video_info')
         if not video_info:
             raise ValueError("Sesi telah berakhir")
         
-        yt = video_info['yt_object']
+        info = await get_cached_info(video_info['video_id'], video_info['url'])
         chat_id = update.effective_chat.id
         
         # Step 1: Persiapkan download
-        await query.edit_message_text(
+        await edit_status(
+            query, context,
             text="⏳ <b>Mempersiapkan download video...</b>",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         await context.bot.send_chat_action(chat_id, ChatAction.RECORD_VIDEO)
         
-        # Step 2: Download video
-        try:
-            stream = yt.streams.filter(
-                progressive=True,
-                file_extension='mp4'
-            ).order_by('resolution').desc().first()
+        async with download_slot(query, context):
+            # Folder kerja per request agar file antar user tidak bertabrakan
+            user_id = update.effective_user.id
+            work_dir = await run_blocking(lambda: tempfile.mkdtemp(prefix=f"u{user_id}_", dir=TEMP_DIR))
             
-            if not stream:
-                raise ValueError("Tidak bisa menemukan stream yang sesuai")
+            # Format (dan kelayakan kompres ulang) sudah dicek di process_link
+            format_ids = video_info.get('format_ids') \
+                or YouTubeDownloader.pick_formats(info, prefer_m4a=AUDIO_OUTPUT == 'm4a')
+            format_id = format_ids.get('mp4')
+            needs_shrink = format_ids.get('mp4_shrink', False)
+            if not format_id:
+                # Video terlalu panjang untuk dikompres ke 50MB: tolak sebelum download
+                raise ValueError("File terlalu besar (>50MB)")
+            
+            # Step 2: Download video
+            try:
+                video_path = await YouTubeDownloader.download(info, format_id, work_dir)
+            except Exception as e:
+                raise ValueError(f"Gagal mendownload video: {str(e)}")
             
-            video_path = stream.download(
-                output_path=TEMP_DIR,
-                filename_prefix="video_"
+            if needs_shrink:
+                await edit_status(query, context, "🔧 <b>Mengompres video agar muat 50MB...</b>")
+                try:
+                    video_path = await YouTubeDownloader.shrink_video(
+                        video_path, os.path.join(work_dir, "shrunk.mp4"), video_info['length']
+                    )
+                except ValueError:
+                    raise
+                except Exception as e:
+                    raise ValueError(f"Kompresi gagal: {str(e)}")
+            
+            # Step 3: Kirim video (progres upload ditunjukkan lewat chat action)
+            caption = video_info['title'][:60]
+            if needs_shrink:
+                # Beri tahu user bahwa kualitas video sudah diturunkan
+                caption += "\n🔧 Dikompres agar muat 50MB (kualitas diturunkan)"
+            video_format = next(
+                (f for f in info['formats'] if f['format_id'] == format_id.split('+')[0]), {}
             )
-        except Exception as e:
-            raise ValueError(f"Gagal mendownload video: {str(e)}")
-        
-        # Step 3: Kirim video
-        await query.edit_message_text(
-            text="📤 <b>Mengunggah video...</b>",
-            parse_mode=ParseMode.HTML
-        )
-        await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_VIDEO)
-        
-        try:
-            with open(video_path, 'rb') as video_file:
+            await context.bot.send_chat_action(chat_id, ChatAction.UPLOAD_VIDEO)
+            
+            try:
                 await context.bot.send_video(
                     chat_id=chat_id,
-                    video=video_file,
-                    caption=video_info['title'][:60],
+                    video=await read_upload(video_path),
+                    filename=os.path.basename(video_path),
+                    caption=caption,
                     supports_streaming=True,
-                    width=1280,
-                    height=720,
+                    # Dimensi asli format video (bisa 1080p atau vertikal untuk Shorts)
+                    width=video_format.get('width'),
+                    height=video_format.get('height'),
                     read_timeout=60,
                     write_timeout=60
                 )
-        except Exception as e:
-            raise ValueError(f"Upload gagal: {str(e)}")
-        
-        # Bersihkan file
-        try:
-            if os.path.exists(video_path):
-                os.remove(video_path)
-        except Exception as e:
-            logger.error(f"Error membersihkan file: {str(e)}")
+            except Exception as e:
+                raise ValueError(f"Upload gagal: {str(e)}")
         
         # Pesan sukses
-        await query.edit_message_text(
+        await edit_status(
+            query, context,
             text="✅ <b>Video berhasil diunduh!</b>\n"
                  "Selamat menonton! 🎬",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         
         return MENU
         
     except ValueError as e:
-        await query.edit_message_text(
-            text=f"❌ <b>Error:</b> {str(e)}\n\n"
+        await edit_status(
+            query, context,
+            text=f"❌ <b>Error:</b> {html.escape(str(e))}\n\n"
                  "Silakan coba lagi atau mulai sesi baru dengan /start",
-            parse_mode=ParseMode.HTML
-        )
-        return MENU
-        
-    except Exception as e:
-        logger.error(f"Error tak terduga di download_mp4: {str(e)}")
-        await query.edit_message_text(
-            text="❌ <b>Terjadi error tak terduga!</b>\n"
-                 "Silakan coba lagi nanti.",
-            parse_mode=ParseMode.HTML
+            force=True
         )
         return MENU
+    
+    finally:
+        # Hapus folder kerja di thread agar unlink tidak memblokir event loop
+        if work_dir:
+            await run_blocking(shutil.rmtree, work_dir, True)
+        # Info video tidak dibutuhkan lagi setelah kembali ke MENU
+        context.user_data.pop('video_info', None)
+        context.user_data.pop('last_status', None)
 
+@safe_handler()
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Menampilkan pesan bantuan"""
-    try:
-        help_text = """
+    help_text = """
 ℹ️ <b>Bantuan YouTube Downloader</b>
 
 🔹 <u>Cara menggunakan:</u>
 1. Pilih menu Download
 2. Kirim link video YouTube
-3. Pilih format (MP3/MP4)
+3. Pilih format (Audio/MP4)
 4. Tunggu proses selesai
 
 ⚠️ <u>Catatan:</u>
@@ -423,36 +508,49 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 - https://youtu.be/contoh
 - https://www.youtube.com/watch?v=contoh
 - https://youtube.com/shorts/contoh"""
-        
-        buttons = [
-            [InlineKeyboardButton("⬅️ Kembali ke Menu", callback_data='back')]
-        ]
-        
-        await update.message.reply_text(
-            text=help_text,
-            reply_markup=InlineKeyboardMarkup(buttons),
-            parse_mode=ParseMode.HTML
-        )
-        return MENU
-    except Exception as e:
-        logger.error(f"Error di help_command: {e}")
-        await update.message.reply_text(
-            "❌ Gagal menampilkan bantuan. Silakan coba lagi.",
-            parse_mode=ParseMode.HTML
-        )
-        return MENU
+    
+    # Dipanggil dari tombol "Bantuan", jadi jawab callback-nya dulu
+    if update.callback_query:
+        await update.callback_query.answer()
+    await update.effective_message.reply_text(
+        text=help_text,
+        reply_markup=HELP_BACK_MARKUP,
+        parse_mode=ParseMode.HTML
+    )
+    return MENU
 
+@safe_handler()
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Kembali ke menu utama"""
-    try:
-        query = update.callback_query
-        await query.answer()
-        
-        await start(update, context)
-        return MENU
-    except Exception as e:
-        logger.error(f"Error di cancel: {e}")
-        return MENU
+    query = update.callback_query
+    await query.answer()
+    
+    await start(update, context)
+    return MENU
+
+async def conversation_timeout(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Bersihkan data sesi saat conversation timeout"""
+    context.user_data.pop('video_info', None)
+    return ConversationHandler.END
+
+async def sweep_temp_dir(context: ContextTypes.DEFAULT_TYPE):
+    """Job berkala untuk menghapus sisa file lama di TEMP_DIR"""
+    await run_blocking(_sweep_temp_dir)
+
+def _sweep_temp_dir():
+    """Hapus entri TEMP_DIR yang lebih tua dari TEMP_MAX_AGE (dijalankan di thread)"""
+    cutoff = time.time() - TEMP_MAX_AGE
+    with os.scandir(TEMP_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.unlink(entry.path)
+            except OSError as e:
+                logger.error(f"Error membersihkan {entry.path}: {e}")
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Menangani semua error yang tidak tertangani"""
@@ -481,16 +579,72 @@ Silakan coba lagi atau mulai sesi baru dengan /start"""
     
     return MENU
 
+def callback_router(routes: dict) -> CallbackQueryHandler:
+    """Satu CallbackQueryHandler per state; callback_data dicocokkan lewat lookup dict, bukan regex"""
+    async def dispatch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await routes[update.callback_query.data](update, context)
+    return CallbackQueryHandler(dispatch, pattern=routes.__contains__)
+
+async def post_init(application: Application):
+    """Siapkan resource bersama saat bot mulai"""
+    await open_http_session()
+
+async def post_shutdown(application: Application):
+    """Lepaskan resource bersama saat bot berhenti"""
+    await close_http_session()
+
+def get_webhook_url():
+    """Cari URL publik untuk webhook (WEBHOOK_URL, Railway, atau Heroku)"""
+    if os.getenv('WEBHOOK_URL'):
+        return os.getenv('WEBHOOK_URL').rstrip('/')
+    if os.getenv('RAILWAY_STATIC_URL'):
+        return f"https://{os.getenv('RAILWAY_STATIC_URL')}"
+    if os.getenv('HEROKU_APP_NAME'):
+        return f"https://{os.getenv('HEROKU_APP_NAME')}.herokuapp.com"
+    return None
+
 def main():
     """Jalankan bot"""
     try:
+        # Simpan user_data dan state conversation agar selamat dari restart
+        persistence = PicklePersistence(
+            filepath=PERSISTENCE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False)
+        )
+        
+        # Koneksi HTTP/2 dengan pool besar agar koneksi ke Bot API dipakai ulang
+        request = HTTPXRequest(
+            connection_pool_size=64,
+            http_version='2',
+            read_timeout=60,
+            write_timeout=60,
+            connect_timeout=30,
+            pool_timeout=60
+        )
+        # getUpdates memakai pool terpisah agar long polling tidak memblokir request lain
+        get_updates_request = HTTPXRequest(
+            http_version='2',
+            read_timeout=60,
+            connect_timeout=30,
+            pool_timeout=60
+        )
+        
         # Buat aplikasi dengan timeout yang lebih panjang
         application = Application.builder() \
             .token(TOKEN) \
-            .read_timeout(60) \
-            .write_timeout(60) \
-            .connect_timeout(30) \
-            .pool_timeout(60) \
+            .request(request) \
+            .get_updates_request(get_updates_request) \
+            .persistence(persistence) \
+            .concurrent_updates(True) \
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=30,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+                max_retries=3
+            )) \
+            .post_init(post_init) \
+            .post_shutdown(post_shutdown) \
             .build()
         
         # Setup ConversationHandler
@@ -498,30 +652,47 @@ def main():
             entry_points=[CommandHandler('start', start)],
             states={
                 MENU: [
-                    CallbackQueryHandler(handle_download, pattern='^download$'),
-                    CallbackQueryHandler(help_command, pattern='^help$'),
-                    CallbackQueryHandler(cancel, pattern='^back$')
+                    callback_router({'download': handle_download, 'help': help_command, 'back': cancel})
                 ],
                 PROCESSING_LINK: [
                     MessageHandler(filters.TEXT & ~filters.COMMAND, process_link),
-                    CallbackQueryHandler(cancel, pattern='^back$')
+                    callback_router({'back': cancel})
                 ],
                 CHOOSING_FORMAT: [
-                    CallbackQueryHandler(download_mp3, pattern='^mp3$'),
-                    CallbackQueryHandler(download_mp4, pattern='^mp4$'),
-                    CallbackQueryHandler(cancel, pattern='^back$')
+                    callback_router({'audio': download_audio, 'mp4': download_mp4, 'back': cancel})
+                ],
+                ConversationHandler.TIMEOUT: [
+                    TypeHandler(Update, conversation_timeout)
                 ]
             },
             fallbacks=[CommandHandler('start', start)],
-            conversation_timeout=300  # 5 menit timeout untuk conversation
+            conversation_timeout=300,  # 5 menit timeout untuk conversation
+            name='download_conversation',
+            persistent=True
         )
         
         application.add_handler(conv_handler)
         application.add_error_handler(error_handler)
         
-        # Jalankan bot
-        logger.info("Bot sedang berjalan...")
-        application.run_polling(drop_pending_updates=True)
+        # Sapu TEMP_DIR tiap 10 menit untuk file yang tertinggal
+        application.job_queue.run_repeating(sweep_temp_dir, interval=600, first=60)
+        
+        # Jalankan bot: webhook jika ada URL publik, polling hanya untuk lokal
+        webhook_url = get_webhook_url()
+        if webhook_url:
+            logger.info(f"Bot sedang berjalan (webhook) di port {PORT}...")
+            application.run_webhook(
+                listen='0.0.0.0',
+                port=PORT,
+                url_path=TOKEN,
+                webhook_url=f"{webhook_url}/{TOKEN}",
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=True
+            )
+        else:
+            logger.info("Bot sedang berjalan (polling)...")
+            application.run_polling(drop_pending_updates=True)
         
     except Exception as e:
         logger.error(f"Error di main: {e}")
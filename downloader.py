@@ -0,0 +1,519 @@
+import os
+import re
+import io
+import shutil
+import asyncio
+import functools
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import aiofiles
+import aiohttp
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+
+# Opsi dasar yt-dlp (download fragmen secara paralel)
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'noplaylist': True,
+    'concurrent_fragment_downloads': 4,
+    # Mulai langsung dengan blok baca 1 MiB, bukan 1 KiB yang lalu membesar
+    'buffersize': 1024 * 1024,
+    # Unduh per range 10 MiB; YouTube memperlambat GET tanpa Range
+    'http_chunk_size': 10 * 1024 * 1024
+}
+# Thread pool khusus untuk kerja blocking (yt-dlp, PyAV) di luar event loop
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+EXECUTOR = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='downloader')
+# Pool terpisah untuk tulis file range, agar tidak antri di belakang yt-dlp
+WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='writer')
+MAX_FILE_SIZE = 50 * 1024 * 1024  # Batas upload Bot API Telegram
+# Kompres ulang video yang >50MB (re-encode, kualitas turun); nonaktif kecuali diaktifkan
+ENABLE_SHRINK = os.getenv('ENABLE_SHRINK', '').lower() in ('1', 'true', 'yes')
+SHRINK_AUDIO_KBPS = 96  # Bitrate audio saat video dikompres ulang
+MIN_SHRINK_VIDEO_KBPS = 100  # Di bawah ini video hasil kompres tidak layak ditonton
+CHUNK_SIZE = 256 * 1024  # Ukuran potongan baca/tulis saat download langsung
+PARALLEL_THRESHOLD = 10 * 1024 * 1024  # File di atas ini diunduh per range secara paralel
+RANGE_SIZE = 10 * 1024 * 1024  # Ukuran range default jika yt-dlp tidak memberi http_chunk_size
+FFMPEG_PATH = shutil.which('ffmpeg')
+
+# Pola URL YouTube dalam satu regex, dikompilasi sekali; grup 1 adalah ID video
+YOUTUBE_URL_RE = re.compile(
+    r'^(?:https?://)?(?:www\.)?(?:youtube\.com/(?:watch\?v=|shorts/|embed/)|youtu\.be/)([A-Za-z0-9_-]{6,})',
+    re.IGNORECASE
+)
+# Awalan yang mungkin dimiliki URL YouTube; pesan lain ditolak tanpa regex
+YOUTUBE_URL_PREFIXES = ('http://', 'https://', 'www.', 'youtube.com', 'youtu.be')
+
+_local = threading.local()
+
+# Session HTTP bersama untuk download langsung, dibuka/ditutup oleh bot
+http_session = None
+# Batasi jumlah request range bersamaan agar tidak kena 429
+RANGE_SEMAPHORE = asyncio.Semaphore(8)
+
+async def open_http_session():
+    """Buka session aiohttp bersama (dipanggil saat aplikasi mulai)"""
+    global http_session
+    http_session = aiohttp.ClientSession(
+        # Koneksi keep-alive dan cache DNS dipakai ulang lintas download
+        connector=aiohttp.TCPConnector(
+            limit=128, limit_per_host=16, ttl_dns_cache=300, keepalive_timeout=75
+        ),
+        timeout=aiohttp.ClientTimeout(total=600)
+    )
+
+async def close_http_session():
+    """Tutup session aiohttp bersama (dipanggil saat aplikasi berhenti)"""
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+def _get_ydl() -> YoutubeDL:
+    """YoutubeDL per thread worker, dipakai ulang agar koneksi HTTP dan cache player JS tetap hangat"""
+    ydl = getattr(_local, 'ydl', None)
+    if ydl is None:
+        ydl = _local.ydl = YoutubeDL(YDL_OPTS)
+    return ydl
+
+async def run_blocking(func, *args):
+    """Jalankan fungsi blocking di EXECUTOR tanpa menahan event loop"""
+    return await asyncio.get_running_loop().run_in_executor(EXECUTOR, func, *args)
+
+async def run_write(func, *args):
+    """Jalankan operasi tulis file singkat di WRITE_EXECUTOR"""
+    return await asyncio.get_running_loop().run_in_executor(WRITE_EXECUTOR, func, *args)
+
+def content_range_total(resp) -> int:
+    """Ukuran total file dari header Content-Range respons 206, None jika tidak ada"""
+    total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+def preallocate(fd: int, size: int):
+    """Alokasikan ukuran file di awal (best-effort); ftruncate jika posix_fallocate tidak bisa"""
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return
+            except OSError:
+                pass  # Mis. filesystem jaringan tanpa dukungan fallocate
+        os.ftruncate(fd, size)
+    except OSError:
+        pass  # Tanpa alokasi awal, penulisan tetap berjalan normal
+
+@functools.lru_cache(maxsize=None)
+def video_encoder_args() -> tuple:
+    """Argumen encoder H.264 tercepat yang tersedia, dicek sekali saja"""
+    for args in (('-c:v', 'h264_nvenc', '-preset', 'p4'),
+                 ('-c:v', 'h264_qsv', '-preset', 'veryfast')):
+        try:
+            # Encoder GPU bisa terdaftar tanpa hardware-nya, jadi uji dengan encode singkat
+            probe = subprocess.run(
+                [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error',
+                 '-f', 'lavfi', '-i', 'nullsrc=s=256x256:d=0.1',
+                 *args, '-f', 'null', '-'],
+                capture_output=True, timeout=15
+            )
+            if probe.returncode == 0:
+                return args
+        except (OSError, subprocess.SubprocessError):
+            pass
+    return ('-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency')
+
+@functools.lru_cache(maxsize=None)
+def hwaccel_args() -> tuple:
+    """Argumen decode hardware jika ffmpeg mendukung hwaccel, dicek sekali saja"""
+    try:
+        output = subprocess.run(
+            [FFMPEG_PATH, '-hide_banner', '-hwaccels'],
+            capture_output=True, text=True, timeout=15
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ()
+    # Baris pertama hanya judul "Hardware acceleration methods:"
+    methods = [line.strip() for line in output.splitlines()[1:] if line.strip()]
+    # 'auto' otomatis kembali ke decode software jika device tidak tersedia
+    return ('-hwaccel', 'auto') if methods else ()
+
+class YouTubeDownloader:
+    @staticmethod
+    def validate_url(url: str) -> bool:
+        """Validasi URL YouTube"""
+        return YouTubeDownloader.extract_video_id(url) is not None
+
+    @staticmethod
+    def extract_video_id(url: str):
+        """Ambil ID video dari URL YouTube, None jika URL tidak valid"""
+        if not url[:11].lower().startswith(YOUTUBE_URL_PREFIXES):
+            return None
+        match = YOUTUBE_URL_RE.match(url)
+        return match.group(1) if match else None
+
+    @staticmethod
+    async def get_video_info(url: str) -> dict:
+        """Dapatkan info video dengan error handling"""
+        try:
+            info = await run_blocking(YouTubeDownloader._extract_info, url)
+            # Test akses ke properti dasar
+            if not all([info.get('title'), info.get('uploader'), info.get('duration')]):
+                raise DownloadError("Video info tidak lengkap")
+            return info
+        except DownloadError as e:
+            raise ValueError(f"Video tidak tersedia: {str(e)}")
+        except Exception as e:
+            raise ValueError(f"Error tak terduga: {str(e)}")
+
+    @staticmethod
+    def _extract_info(url: str) -> dict:
+        return _get_ydl().extract_info(url, download=False)
+
+    @staticmethod
+    def pick_format(info: dict, audio_only: bool, prefer_m4a: bool = True) -> str:
+        """Pilih format terbaik yang masih muat di batas upload Telegram"""
+        def size(fmt):
+            return fmt.get('filesize') or fmt.get('filesize_approx') or 0
+        
+        # yt-dlp mengurutkan format dari kualitas terendah ke tertinggi
+        formats = info.get('formats') or []
+        audios = [f for f in formats
+                  if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+        best_audio = next((f for f in reversed(audios)
+                           if f.get('ext') == 'm4a' and size(f) <= MAX_FILE_SIZE), None)
+        
+        if audio_only:
+            candidates = audios
+            if prefer_m4a:
+                # Dahulukan m4a agar bisa di-copy, urutan kualitas tetap terjaga
+                candidates = sorted(audios, key=lambda f: f.get('ext') == 'm4a')
+            # Tanpa prefer_m4a (akan di-transcode) ambil bitrate tertinggi
+            for fmt in reversed(candidates):
+                if size(fmt) <= MAX_FILE_SIZE:
+                    return fmt['format_id']
+        else:
+            # Video H.264 adaptif + audio m4a, cukup di-remux tanpa re-encode
+            if FFMPEG_PATH and best_audio:
+                for video in reversed(formats):
+                    if (video.get('ext') == 'mp4'
+                            and video.get('acodec') == 'none'
+                            and (video.get('vcodec') or '').startswith('avc1')
+                            and size(video) + size(best_audio) <= MAX_FILE_SIZE):
+                        return f"{video['format_id']}+{best_audio['format_id']}"
+            
+            # Fallback ke stream progressive (video+audio dalam satu file)
+            candidates = [f for f in formats
+                          if f.get('ext') == 'mp4'
+                          and f.get('vcodec') not in (None, 'none')
+                          and f.get('acodec') not in (None, 'none')]
+            for fmt in reversed(candidates):
+                if size(fmt) <= MAX_FILE_SIZE:
+                    return fmt['format_id']
+        
+        if not candidates:
+            raise ValueError("Tidak bisa menemukan stream yang sesuai")
+        raise ValueError("File terlalu besar (>50MB)")
+
+    @staticmethod
+    def shrink_bitrate(duration: int) -> int:
+        """Bitrate video (kbps) agar hasil kompres muat di MAX_FILE_SIZE; ValueError jika terlalu rendah"""
+        # Sisakan 5% untuk overhead kontainer
+        video_kbps = int(MAX_FILE_SIZE * 8 * 0.95 / 1000 / max(duration, 1)) - SHRINK_AUDIO_KBPS
+        if video_kbps < MIN_SHRINK_VIDEO_KBPS:
+            raise ValueError("File terlalu besar (>50MB)")
+        return video_kbps
+
+    @staticmethod
+    def pick_shrink_format(info: dict) -> str:
+        """Format MP4 progressive terkecil sebagai bahan kompres ulang"""
+        if not ENABLE_SHRINK or not FFMPEG_PATH:
+            raise ValueError("File terlalu besar (>50MB)")
+        # Cek durasi dulu agar video yang pasti gagal dikompres tidak didownload
+        YouTubeDownloader.shrink_bitrate(int(info.get('duration') or 0))
+        for fmt in info.get('formats') or []:
+            if (fmt.get('ext') == 'mp4'
+                    and fmt.get('vcodec') not in (None, 'none')
+                    and fmt.get('acodec') not in (None, 'none')):
+                return fmt['format_id']
+        raise ValueError("Tidak bisa menemukan stream yang sesuai")
+
+    @staticmethod
+    def pick_formats(info: dict, prefer_m4a: bool = True) -> dict:
+        """Pilih format audio dan MP4 sekaligus; None jika tidak ada yang cocok, alasannya di 'reason'"""
+        format_ids = {'mp4_shrink': False, 'reason': None}
+        for key, audio_only in (('audio', True), ('mp4', False)):
+            try:
+                format_ids[key] = YouTubeDownloader.pick_format(info, audio_only, prefer_m4a)
+            except ValueError as e:
+                format_ids[key] = None
+                format_ids['reason'] = str(e)
+        
+        if not format_ids['mp4']:
+            # Tidak ada MP4 yang muat: pakai yang terkecil lalu kompres, jika durasinya memungkinkan
+            try:
+                format_ids['mp4'] = YouTubeDownloader.pick_shrink_format(info)
+                format_ids['mp4_shrink'] = True
+            except ValueError:
+                pass
+        return format_ids
+
+    @staticmethod
+    async def download(info: dict, fmt: str, output_dir: str) -> str:
+        """Download format yang dipilih dari info yang sudah diekstrak"""
+        formats = {f['format_id']: f for f in info['formats']}
+        parts = [formats[format_id] for format_id in fmt.split('+')]
+        
+        # Format HTTP biasa diunduh langsung secara async; DASH/HLS lewat yt-dlp
+        if http_session is None or any(f.get('protocol') not in ('http', 'https') for f in parts):
+            return await run_blocking(YouTubeDownloader._download, info, fmt, output_dir)
+        
+        if len(parts) == 1:
+            path = os.path.join(output_dir, f"{info['id']}.{parts[0]['ext']}")
+            return await YouTubeDownloader._fetch(parts[0], path)
+        
+        # Video dan audio diunduh bersamaan
+        paths = await asyncio.gather(*(
+            YouTubeDownloader._fetch(
+                part, os.path.join(output_dir, f"{info['id']}.f{part['format_id']}.{part['ext']}")
+            )
+            for part in parts
+        ))
+        return await YouTubeDownloader.merge_streams(paths, os.path.join(output_dir, f"{info['id']}.mp4"))
+
+    @staticmethod
+    async def _fetch(fmt: dict, path: str) -> str:
+        """Unduh satu format ke file dengan aiohttp, per range seperti yt-dlp"""
+        headers = dict(fmt.get('http_headers') or {})
+        # YouTube memperlambat request tanpa Range, jadi ikuti http_chunk_size dari yt-dlp
+        range_size = (fmt.get('downloader_options') or {}).get('http_chunk_size')
+        total = fmt.get('filesize') or await YouTubeDownloader._content_length(fmt['url'], headers)
+        
+        if total and total > PARALLEL_THRESHOLD:
+            result = await YouTubeDownloader._fetch_parallel(
+                fmt['url'], headers, total, range_size or RANGE_SIZE, path
+            )
+            if result:
+                return result
+            # Server tidak mendukung Range: lanjut dengan loop berurutan di bawah
+        
+        async with aiofiles.open(path, 'wb', buffering=65536) as f:
+            if total:
+                # Alokasikan sekaligus agar file tidak terfragmentasi saat ditulis bertahap
+                await run_write(preallocate, f.fileno(), total)
+            start = 0
+            while True:
+                if range_size:
+                    headers['Range'] = f"bytes={start}-{start + range_size - 1}"
+                async with http_session.get(fmt['url'], headers=headers) as resp:
+                    if range_size and resp.status == 416:
+                        # Range di luar file: ukuran tepat kelipatan range, file sudah lengkap
+                        break
+                    resp.raise_for_status()
+                    # Hanya 206 yang berarti Range dihormati; selain itu body adalah file utuh
+                    ranged = bool(range_size) and resp.status == 206
+                    if ranged and not total:
+                        total = content_range_total(resp)
+                    if not ranged and start:
+                        # Server mengabaikan Range di tengah jalan: tulis ulang dari awal
+                        await f.seek(0)
+                        start = 0
+                    received = 0
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        await f.write(chunk)
+                        received += len(chunk)
+                start += received
+                # Selesai jika body utuh, potongan terakhir lebih pendek, atau ukuran tercapai
+                if not ranged or received < range_size or (total and start >= total):
+                    break
+            if total and start != total:
+                # Ukuran dari yt-dlp meleset: buang sisa alokasi di akhir file
+                await f.truncate(start)
+        return path
+
+    @staticmethod
+    async def _content_length(url: str, headers: dict):
+        """Ambil Content-Length lewat HEAD, None jika tidak diketahui"""
+        try:
+            async with http_session.head(url, headers=headers, allow_redirects=True) as resp:
+                resp.raise_for_status()
+                return resp.content_length
+        except aiohttp.ClientError:
+            return None
+
+    @staticmethod
+    async def _fetch_parallel(url: str, headers: dict, total: int, range_size: int, path: str):
+        """Unduh file besar per range secara paralel; None jika server tidak mendukung Range"""
+        # Range pertama sekaligus jadi probe sebelum file dialokasikan
+        first = await http_session.get(url, headers={**headers, 'Range': f"bytes=0-{range_size - 1}"})
+        async with first:
+            first.raise_for_status()
+            if first.status != 206:
+                return None
+            # Ukuran dari yt-dlp/HEAD bisa meleset; Content-Range yang menentukan
+            total = content_range_total(first) or total
+            
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                # Alokasikan ukuran penuh di awal agar tiap range bisa ditulis di offset-nya
+                await run_write(preallocate, fd, total)
+                
+                async def write_range(resp, lo: int, hi: int):
+                    offset = lo
+                    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                        await run_write(os.pwrite, fd, chunk, offset)
+                        offset += len(chunk)
+                    if offset != hi + 1:
+                        raise aiohttp.ClientPayloadError(f"Range {lo}-{hi} tidak lengkap")
+                
+                async def fetch_range(lo: int, hi: int):
+                    async with RANGE_SEMAPHORE:
+                        async with http_session.get(url, headers={**headers, 'Range': f"bytes={lo}-{hi}"}) as resp:
+                            resp.raise_for_status()
+                            if resp.status != 206:
+                                # Body utuh tidak boleh ditulis di offset range
+                                raise aiohttp.ClientPayloadError(f"Range {lo}-{hi} tidak didukung server")
+                            await write_range(resp, lo, hi)
+                
+                tasks = [asyncio.ensure_future(write_range(first, 0, min(range_size, total) - 1))]
+                tasks += [
+                    asyncio.ensure_future(fetch_range(lo, min(lo + range_size, total) - 1))
+                    for lo in range(range_size, total, range_size)
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                except BaseException:
+                    # Hentikan range lain sebelum fd ditutup
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+            finally:
+                os.close(fd)
+        return path
+
+    @staticmethod
+    async def merge_streams(paths: list, output_path: str) -> str:
+        """Gabung video dan audio dengan -c copy (tanpa re-encode) + faststart"""
+        inputs = []
+        for path in paths:
+            inputs += ['-i', path]
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, *inputs,
+            '-c', 'copy', '-movflags', '+faststart',
+            '-y', '-loglevel', 'error', output_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='ignore').strip() or f"ffmpeg exit {proc.returncode}")
+        return output_path
+
+    @staticmethod
+    def _download(info: dict, fmt: str, output_dir: str) -> str:
+        opts = dict(
+            YDL_OPTS,
+            format=fmt,
+            outtmpl=os.path.join(output_dir, "%(id)s.%(ext)s"),
+            # Gabung video+audio dengan -c copy; faststart agar bisa di-stream
+            merge_output_format='mp4',
+            postprocessor_args={'merger': ['-movflags', '+faststart']}
+        )
+        # Format sudah dipilih; sisakan hanya format itu agar yt-dlp tidak
+        # menyalin dan mengurutkan ulang seluruh daftar format
+        wanted = set(fmt.split('+'))
+        info = dict(info, formats=[f for f in info['formats'] if f['format_id'] in wanted])
+        with YoutubeDL(opts) as ydl:
+            # Pakai ulang hasil extract_info agar metadata tidak diambil dua kali
+            result = ydl.process_ie_result(
+                ydl.sanitize_info(info, remove_private_keys=True),
+                download=True
+            )
+        return result['requested_downloads'][0]['filepath']
+
+    @staticmethod
+    async def convert_to_mp3(input_path: str) -> bytes:
+        """Konversi audio ke MP3 dengan ffmpeg, hasil dibaca langsung dari pipe"""
+        if not FFMPEG_PATH:
+            return await run_blocking(YouTubeDownloader._convert_with_av, input_path)
+        
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, '-i', input_path,
+            '-vn', '-map', '0:a:0',
+            '-c:a', 'libmp3lame', '-q:a', '2', '-threads', '0',
+            '-f', 'mp3', '-loglevel', 'error', 'pipe:1',
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        # communicate() menguras stdout dan stderr bersamaan agar pipe tidak deadlock
+        mp3_data, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='ignore').strip() or f"ffmpeg exit {proc.returncode}")
+        return mp3_data
+
+    @staticmethod
+    async def remux_audio(input_path: str, output_path: str) -> str:
+        """Salin track audio ke .m4a tanpa re-encode (hanya I/O)"""
+        if not FFMPEG_PATH:
+            # Tanpa ffmpeg, kirim file hasil yt-dlp apa adanya
+            return input_path
+        
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, '-i', input_path,
+            '-vn', '-c:a', 'copy', '-movflags', '+faststart',
+            '-y', '-loglevel', 'error', output_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='ignore').strip() or f"ffmpeg exit {proc.returncode}")
+        return output_path
+
+    @staticmethod
+    async def shrink_video(input_path: str, output_path: str, duration: int) -> str:
+        """Re-encode video dengan bitrate yang dihitung agar muat di MAX_FILE_SIZE"""
+        video_kbps = YouTubeDownloader.shrink_bitrate(duration)
+        
+        encoder_args = await run_blocking(video_encoder_args)
+        decoder_args = await run_blocking(hwaccel_args)
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, *decoder_args, '-i', input_path,
+            *encoder_args,
+            '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps}k',
+            '-bufsize', f'{video_kbps * 2}k',
+            '-c:a', 'aac', '-b:a', f'{SHRINK_AUDIO_KBPS}k',
+            '-movflags', '+faststart',
+            '-y', '-loglevel', 'error', output_path,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='ignore').strip() or f"ffmpeg exit {proc.returncode}")
+        # Bitrate encoder tidak selalu tepat; jangan biarkan upload yang gagal
+        if os.path.getsize(output_path) > MAX_FILE_SIZE:
+            raise ValueError("File terlalu besar (>50MB) meski sudah dikompres")
+        return output_path
+
+    @staticmethod
+    def _convert_with_av(input_path: str) -> bytes:
+        """Konversi ke MP3 in-process dengan PyAV (libav di C, tanpa numpy)"""
+        # Opsional dan berat; hanya diimport jika binary ffmpeg tidak tersedia
+        try:
+            import av
+        except ImportError:
+            raise RuntimeError("ffmpeg tidak ditemukan")
+        
+        buffer = io.BytesIO()
+        with av.open(input_path) as inp, av.open(buffer, 'w', format='mp3') as out:
+            in_stream = inp.streams.audio[0]
+            out_stream = out.add_stream('mp3', rate=in_stream.rate)
+            out_stream.bit_rate = 128000
+            for frame in inp.decode(in_stream):
+                for packet in out_stream.encode(frame):
+                    out.mux(packet)
+            for packet in out_stream.encode(None):
+                out.mux(packet)
+        return buffer.getvalue()